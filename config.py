@@ -1,5 +1,5 @@
 import pydantic
-from typing import List
+from typing import List, Optional
 
 
 class Config(pydantic.BaseModel):
@@ -11,3 +11,40 @@ class Config(pydantic.BaseModel):
                                     'fewer digits, cropped, worst quality, low quality, normal quality, ' \
                                     'jpeg artifacts, signature, watermark, username, blurry'
     available_modules: List[str] = []
+    hires_scale: float = 2
+    hires_tile_overlap: int = 64
+    hires_denoise: float = 0.35
+    trace_sample_rate: float = 0
+    trace_export_file: Optional[str] = None
+    trace_otlp_endpoint: Optional[str] = None
+    trace_batch_size: int = 64
+    trace_flush_interval: float = 5
+    trace_max_pending_spans: int = 4096
+    admin_user_ids: List[int] = []
+    watchdog_interval: float = 0.5
+    watchdog_threshold: float = 1
+    profile_max_seconds: int = 60
+    profile_sample_interval: float = 0.005
+    preview_mode: bool = False
+    preview_thumb_size: int = 384
+    preview_quality: int = 80
+    result_store_dir: str = './result_store'
+    result_store_max_bytes: int = 1024 * 1024 * 1024
+    prefetch_enabled: bool = False
+    prefetch_gpu_slots: int = 1
+    prefetch_max_concurrent: int = 1
+    prefetch_gpu_seconds_per_hour: float = 600
+    prefetch_ttl: float = 300
+    prefetch_interval: float = 5
+    sd_api_image_refs: bool = False
+    image_index_max_entries: int = 4096
+    degrade_enabled: bool = False
+    degrade_queue_depth_start: int = 2
+    degrade_queue_depth_full: int = 8
+    degrade_latency_start: float = 60
+    degrade_latency_full: float = 300
+    degrade_min_steps: int = 15
+    degrade_min_pixel_ratio: float = 0.5
+    degrade_retry_poll_interval: float = 10
+    degrade_retry_timeout: float = 1800
+    degrade_retry_stagger: float = 15
@@ -0,0 +1,87 @@
+import math
+import time
+import asyncio
+from typing import Optional
+from config import Config
+from sd_client import SDClient, SDProcessArguments
+
+
+DEGRADABLE_ARGS = ("steps", "size")
+
+
+def _ratio(v: float, start: float, full: float):
+    if full <= start:
+        return 1. if v >= full else 0.
+    return min(1., max(0., (v - start) / (full - start)))
+
+
+class DegradePolicy:
+    """
+    过载时的降级策略
+
+    根据用户直接发起的任务数和这些任务的平均耗时计算负载等级（0~1），按等级逐步降低用户未指定的步长和尺寸。
+    机器人每次只生成一张图，因此不对数量做降级。
+    """
+    def __init__(self, config: Config, sd_client: SDClient):
+        self._config = config
+        self._sd_client = sd_client
+        self._retry_lock = asyncio.Lock()
+
+    def get_level(self) -> float:
+        if not self._config.degrade_enabled:
+            return 0.
+        inflight = self._sd_client.get_inflight_count(foreground_only=True)
+        depth = _ratio(inflight, self._config.degrade_queue_depth_start, self._config.degrade_queue_depth_full)
+        latency = 0.
+        if inflight > 0:  # 空闲时历史耗时不再代表负载
+            latency = _ratio(self._sd_client.get_avg_latency(), self._config.degrade_latency_start,
+                             self._config.degrade_latency_full)
+        return max(depth, latency)
+
+    def apply(self, args: SDProcessArguments) -> Optional[str]:
+        """
+        对参数进行降级，返回降级说明，没有降级时返回 None
+        """
+        level = self.get_level()
+        if level <= 0:
+            return None
+
+        changes = []
+        if "steps" not in args.explicit_args:
+            steps = max(1, math.floor(args.steps - (args.steps - self._config.degrade_min_steps) * level))
+            if steps < args.steps:
+                changes.append(f"步长 {args.steps}→{steps}")
+                args.steps = steps
+        if "size" not in args.explicit_args:
+            scale = math.sqrt(1 - (1 - self._config.degrade_min_pixel_ratio) * level)
+            width = max(64, math.floor(args.width * scale / 64) * 64)
+            height = max(64, math.floor(args.height * scale / 64) * 64)
+            if width * height < args.width * args.height:
+                changes.append(f"尺寸 {args.width}x{args.height}→{width}x{height}")
+                args.width, args.height = width, height
+        return "，".join(changes) if len(changes) > 0 else None
+
+    async def wait_until_idle(self, should_stop=None) -> bool:
+        """
+        等待负载下降，超时或 should_stop() 为真时返回 False
+
+        等待者依次排队，每次只放行一个，并在放行后间隔一段时间再检查下一个，避免负载下降时所有重试同时涌入。
+        """
+        deadline = time.monotonic() + self._config.degrade_retry_timeout
+        try:
+            await asyncio.wait_for(self._retry_lock.acquire(), self._config.degrade_retry_timeout)
+        except asyncio.TimeoutError:
+            return False
+        try:
+            while self.get_level() > 0:
+                if time.monotonic() >= deadline or (should_stop is not None and should_stop()):
+                    self._retry_lock.release()
+                    return False
+                await asyncio.sleep(self._config.degrade_retry_poll_interval)
+        except BaseException:
+            self._retry_lock.release()
+            raise
+
+        # 留出提交任务的时间后再放行下一个重试
+        asyncio.get_event_loop().call_later(self._config.degrade_retry_stagger, self._retry_lock.release)
+        return True
@@ -0,0 +1,107 @@
+import sys
+import time
+import asyncio
+import logging
+import threading
+import traceback
+from typing import Dict, Optional
+from config import Config
+
+
+def _frame_to_folded(frame) -> str:
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({code.co_filename}:{frame.f_lineno})")
+        frame = frame.f_back
+    names.reverse()
+    return ";".join(names)
+
+
+def sample_stacks(thread_id: int, duration: float, interval: float) -> Dict[str, int]:
+    """
+    对指定线程进行采样，返回折叠栈（flamegraph.pl / speedscope 可直接读取）到采样次数的映射
+
+    需要在被采样线程以外的线程中调用。
+    """
+    ret = {}
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        frame = sys._current_frames().get(thread_id)
+        if frame is not None:
+            key = _frame_to_folded(frame)
+            ret[key] = ret.get(key, 0) + 1
+        del frame
+        time.sleep(interval)
+    return ret
+
+
+def format_folded(stacks: Dict[str, int]) -> str:
+    return "".join([f"{k} {v}\n" for k, v in sorted(stacks.items(), key=lambda x: -x[1])])
+
+
+class LoopWatchdog:
+    """
+    事件循环健康监测
+
+    协程每隔固定时间记录一次心跳并统计调度延迟；独立的监视线程发现心跳超时后，抓取事件循环线程当前的调用栈并写入日志，
+    用于定位阻塞事件循环的同步代码。
+    """
+    def __init__(self, config: Config):
+        self._config = config
+        self._loop_thread_id: Optional[int] = None
+        self._last_beat = time.monotonic()
+        self._stalled = False
+        self._max_lag = 0.
+        self._avg_lag = 0.
+        self._stall_count = 0
+        self._task: Optional[asyncio.Task] = None
+
+    def get_loop_thread_id(self) -> Optional[int]:
+        return self._loop_thread_id
+
+    def get_stats_text(self) -> str:
+        return f"平均延迟：{self._avg_lag * 1000:.1f} ms，最大延迟：{self._max_lag * 1000:.1f} ms，" \
+               f"阻塞次数：{self._stall_count}"
+
+    def start(self):
+        if self._task is not None:
+            return
+        self._loop_thread_id = threading.get_ident()
+        self._last_beat = time.monotonic()
+        self._task = asyncio.ensure_future(self._heartbeat())
+        t = threading.Thread(target=self._monitor, name="LoopWatchdog", daemon=True)
+        t.start()
+
+    async def _heartbeat(self):
+        interval = self._config.watchdog_interval
+        while True:
+            begin = time.monotonic()
+            await asyncio.sleep(interval)
+            now = time.monotonic()
+            lag = max(0., now - begin - interval)
+            self._last_beat = now
+            self._max_lag = max(self._max_lag, lag)
+            self._avg_lag = self._avg_lag * 0.9 + lag * 0.1
+            if lag >= self._config.watchdog_threshold:
+                logging.warning(f"Event loop lag {lag * 1000:.1f} ms")
+
+    def _monitor(self):
+        interval = self._config.watchdog_interval
+        while True:
+            time.sleep(interval / 2)
+            blocked = time.monotonic() - self._last_beat - interval
+            if blocked < self._config.watchdog_threshold:
+                self._stalled = False
+                continue
+            if self._stalled:  # 每次阻塞只记录一次
+                continue
+            self._stalled = True
+            self._stall_count += 1
+
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is None:
+                continue
+            stack = "".join(traceback.format_stack(frame))
+            del frame
+            logging.warning(f"Event loop blocked for {blocked * 1000:.1f} ms, stack:\n{stack}")
@@ -0,0 +1,177 @@
+import time
+import asyncio
+import logging
+from typing import Optional, Dict, Set
+from config import Config
+from sd_client import SDClient, SDProcessResult
+from result_view import RESULT_TXT2IMG
+from tracing import Tracer
+from utils import make_speculative_comment
+
+
+_DEFAULT_RUN_TIME_ESTIMATE = 30  # 尚未观测到执行时间时，每次预取预留的 GPU 秒数
+
+class _Speculation:
+    def __init__(self):
+        self.task: Optional[asyncio.Task] = None
+
+
+class Prefetcher:
+    """
+    “再次施法”的投机预取
+
+    在已提交任务数低于 GPU 数量时，为最近活跃的结果视图在后台提交一次不指定种子的重绘。用户点击“再次施法”时
+    直接使用预取的结果。sd_work_manager 不支持任务优先级和取消，这里通过空闲判断、并发上限和每小时的
+    GPU 时间预算来限制预取对正常请求的影响；过期的预取无法取消，会继续执行到结束并计入浪费。
+    """
+    def __init__(self, config: Config, sd_client: SDClient, tracer: Tracer):
+        self._config = config
+        self._sd_client = sd_client
+        self._tracer = tracer
+        self._active = {}  # type: Dict[object, float]
+        self._speculations = {}  # type: Dict[object, _Speculation]
+        self._orphans = set()  # type: Set[asyncio.Task]
+        self._task: Optional[asyncio.Task] = None
+
+        # 预算
+        self._budget_window_start = time.monotonic()
+        self._budget_used = 0.
+        self._run_time_estimate = float(_DEFAULT_RUN_TIME_ESTIMATE)
+
+        # 统计
+        self._hits = 0
+        self._misses = 0
+        self._wasted_gpu_seconds = 0.
+
+    def touch(self, view):
+        """
+        标记结果视图为活跃
+        """
+        if not self._config.prefetch_enabled:
+            return
+        self._active[view] = time.monotonic()
+
+    async def take(self, view) -> Optional[SDProcessResult]:
+        """
+        取出视图的预取结果，尚在执行时等待其完成
+        """
+        if not self._config.prefetch_enabled:
+            return None
+        self.touch(view)
+
+        spec = self._speculations.pop(view, None)
+        if spec is None:
+            self._misses += 1
+            return None
+        try:
+            result = await spec.task
+        except Exception:
+            logging.exception("Speculative task failed")
+            self._misses += 1
+            return None
+        self._hits += 1
+        return result
+
+    def get_stats_text(self) -> str:
+        total = self._hits + self._misses
+        hit_rate = 0 if total == 0 else self._hits / total * 100
+        return f"预取命中率：{hit_rate:.1f} %（{self._hits}/{total}），浪费 GPU 时间：{self._wasted_gpu_seconds:.1f} 秒"
+
+    def start(self):
+        if self._config.prefetch_enabled and self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self._config.prefetch_interval)
+            try:
+                self._expire()
+                self._launch()
+            except Exception:
+                logging.exception("Prefetch error")
+
+    def _roll_budget_window(self):
+        now = time.monotonic()
+        if now - self._budget_window_start >= 3600:
+            self._budget_window_start = now
+            self._budget_used = 0.
+
+    def _on_speculation_done(self, reserved: float, task: asyncio.Task):
+        # 以实际执行时间修正发起时预留的预算，失败的任务按预留值计
+        actual = reserved
+        if not task.cancelled() and task.exception() is None:
+            actual = task.result().run_time or 0.
+            if actual > 0:
+                self._run_time_estimate = actual
+        self._roll_budget_window()
+        self._budget_used = max(0., self._budget_used + actual - reserved)
+
+    def _discard(self, view):
+        spec = self._speculations.pop(view, None)
+        if spec is None:
+            return
+        if not spec.task.done():
+            # 节点上的任务无法取消，等待其结束后再计入浪费，期间仍占用并发和算力
+            self._orphans.add(spec.task)
+            spec.task.add_done_callback(self._on_orphan_done)
+        else:
+            self._on_discarded_done(spec.task)
+
+    def _on_orphan_done(self, task: asyncio.Task):
+        self._orphans.discard(task)
+        self._on_discarded_done(task)
+
+    def _on_discarded_done(self, task: asyncio.Task):
+        wasted = 0.
+        if not task.cancelled() and task.exception() is None:
+            wasted = task.result().run_time or 0.
+        self._wasted_gpu_seconds += wasted
+        logging.info(f"Speculation discarded, wasted {wasted:.1f}s, {self.get_stats_text()}")
+
+    def _expire(self):
+        now = time.monotonic()
+        for view, last_active in list(self._active.items()):
+            if view.is_finished() or now - last_active > self._config.prefetch_ttl:
+                del self._active[view]
+                self._discard(view)
+
+        # 失败的预取直接丢弃，允许重新发起
+        for view, spec in list(self._speculations.items()):
+            if spec.task.done() and not spec.task.cancelled() and spec.task.exception() is not None:
+                logging.warning(f"Speculative task failed: {spec.task.exception()}")
+                del self._speculations[view]
+
+    def _launch(self):
+        running = len([s for s in self._speculations.values() if not s.task.done()]) + len(self._orphans)
+        if running >= self._config.prefetch_max_concurrent:
+            return
+        if self._sd_client.get_inflight_count() >= self._config.prefetch_gpu_slots:
+            return  # 没有空闲算力
+        self._roll_budget_window()
+        if self._budget_used >= self._config.prefetch_gpu_seconds_per_hour:
+            return
+
+        # 选择最近活跃且尚未预取的视图
+        candidates = [(t, v) for v, t in self._active.items() if v not in self._speculations]
+        if len(candidates) == 0:
+            return
+        _, view = max(candidates, key=lambda x: x[0])
+
+        # 发起时即按估计的执行时间预留预算，执行中和已丢弃的预取同样占用预算
+        reserved = self._run_time_estimate
+        self._budget_used += reserved
+
+        spec = _Speculation()
+        spec.task = asyncio.ensure_future(self._speculate(view))
+        spec.task.add_done_callback(lambda t: self._on_speculation_done(reserved, t))
+        self._speculations[view] = spec
+
+    async def _speculate(self, view) -> SDProcessResult:
+        result_type, args = view.get_reroll_request()
+        with self._tracer.trace("speculate"):
+            args.comment = make_speculative_comment(args.comment)
+            if result_type == RESULT_TXT2IMG:
+                result = await self._sd_client.txt2img(args)
+            else:
+                result = await self._sd_client.img2img(args)
+        return result
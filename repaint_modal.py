@@ -2,6 +2,8 @@ import logging
 import discord
 import discord.ui
 from sd_client import SDProcessArguments
+from utils import make_comment_from_interaction
+from tracing import span
 
 
 def _make_additional_arguments(args: SDProcessArguments):
@@ -17,6 +19,8 @@ def _extract_additional_arguments(target: SDProcessArguments, args: str):
     t = SDProcessArguments()
     t.from_common_args(args)
     target.seed = t.seed
+    if "steps" in t.explicit_args and t.steps != target.steps:  # 与预填值不同时才视为用户指定
+        target.explicit_args.add("steps")
     target.steps = t.steps
     target.module = t.module
 
@@ -45,27 +49,32 @@ class RepaintModal(discord.ui.Modal):
         self.add_item(self._input_additional)
 
     async def on_submit(self, interaction: discord.Interaction):
-        # 参数赋值和检查
-        prompts = str(self._input_prompts).strip()
-        negative = str(self._input_negative).strip()
-        scale = str(self._input_scale).strip()
-        denoise = str(self._input_denoise).strip()
-        additional = str(self._input_additional).strip()
-        try:
-            self._args.prompts = prompts
-            self._args.negative_prompts = negative
-            self._args.scale = float(scale)
-            self._args.denoise = float(denoise)
-            if len(self._args.prompts) == 0:
-                raise RuntimeError("Prompts is empty")
-            _extract_additional_arguments(self._args, additional)
-            self._args.limit_args_range()
-        except Exception:
-            logging.exception("Argument check failed")
-            await interaction.response.send_message(content="非法的咒语")
-            return
+        with self._robot.get_tracer().trace("repaint", user_id=interaction.user.id):
+            # 参数赋值和检查
+            prompts = str(self._input_prompts).strip()
+            negative = str(self._input_negative).strip()
+            scale = str(self._input_scale).strip()
+            denoise = str(self._input_denoise).strip()
+            additional = str(self._input_additional).strip()
+            try:
+                self._args.prompts = prompts
+                self._args.negative_prompts = negative
+                self._args.scale = float(scale)
+                self._args.denoise = float(denoise)
+                if len(self._args.prompts) == 0:
+                    raise RuntimeError("Prompts is empty")
+                _extract_additional_arguments(self._args, additional)
+                self._args.limit_args_range()
+            except Exception:
+                logging.exception("Argument check failed")
+                await interaction.response.send_message(content="非法的咒语")
+                return
 
-        # 发起操作
-        await interaction.response.defer()
-        wb_msg = await interaction.followup.send(content="施法准备中")
-        await self._robot.process_repaint_command(wb_msg, self._args, True)
+            # 在当前 Trace 内重新生成注释，保证与请求头中的 Trace 一致
+            self._args.comment = make_comment_from_interaction(interaction)
+
+            # 发起操作
+            with span("discord.defer"):
+                await interaction.response.defer()
+                wb_msg = await interaction.followup.send(content="施法准备中")
+            await self._robot.process_repaint_command(wb_msg, self._args, True)
@@ -0,0 +1,63 @@
+import os
+import uuid
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import List, Optional
+from config import Config
+
+
+class ResultStore:
+    """
+    本地结果仓库
+
+    预览模式下完整分辨率的图片不随结果消息上传，而是暂存在本地磁盘，按需取用。超出容量时淘汰最早写入的图片。
+    """
+    def __init__(self, config: Config):
+        self._config = config
+        self._index = OrderedDict()  # key -> size
+        self._total_size = 0
+
+        # 上次运行遗留的图片已无法被引用，直接清理
+        os.makedirs(self._config.result_store_dir, exist_ok=True)
+        for name in os.listdir(self._config.result_store_dir):
+            if len(name) == 36 and name.endswith(".png"):  # uuid4().hex + ".png"
+                os.remove(os.path.join(self._config.result_store_dir, name))
+
+    def _path(self, key: str):
+        return os.path.join(self._config.result_store_dir, f"{key}.png")
+
+    def _write(self, keys: List[str], images: List[bytes]):
+        for i in range(0, len(keys)):
+            with open(self._path(keys[i]), "wb") as fp:
+                fp.write(images[i])
+
+    def _read(self, key: str) -> bytes:
+        with open(self._path(key), "rb") as fp:
+            return fp.read()
+
+    def _evict(self):
+        while self._total_size > self._config.result_store_max_bytes and len(self._index) > 0:
+            key, size = self._index.popitem(last=False)
+            self._total_size -= size
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                logging.exception("Remove stored result failed")
+
+    async def put(self, images: List[bytes]) -> List[str]:
+        keys = [uuid.uuid4().hex for _ in images]
+        await asyncio.get_event_loop().run_in_executor(None, self._write, keys, images)
+        for i in range(0, len(keys)):
+            self._index[keys[i]] = len(images[i])
+            self._total_size += len(images[i])
+        self._evict()
+        return keys
+
+    async def get(self, key: str) -> Optional[bytes]:
+        if key not in self._index:
+            return None
+        try:
+            return await asyncio.get_event_loop().run_in_executor(None, self._read, key)
+        except OSError:  # 读取期间被淘汰
+            return None
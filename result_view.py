@@ -1,19 +1,28 @@
+import io
+import time
 import logging
 import discord
 import discord.ui
 from typing import Optional, List
 from sd_client import SDClient, SDProcessResult, SDProcessArguments
-from utils import images_to_attachments, make_comment_from_interaction, ActionButton, select_best_tensor_size
+from utils import make_comment_from_interaction, ActionButton, select_best_tensor_size
 from repaint_modal import RepaintModal
+from tiled_hires import tiled_hires
+from degrade import DEGRADABLE_ARGS
+from tracing import span
 
 
 RESULT_TXT2IMG = 0
 RESULT_IMG2IMG = 1
 
+_MAX_ORIGINAL_BUTTONS = 5
+_PROGRESS_UPDATE_INTERVAL = 3
+
 
 class ResultView(discord.ui.View):
     def __init__(self, robot, parent_msg, result_type: int, args: SDProcessArguments, result: SDProcessResult,
-                 current_content: str, current_attachments: List[discord.File]):
+                 current_content: str, current_attachments: List[discord.File],
+                 current_image_keys: Optional[List[str]] = None, degraded: bool = False):
         super(ResultView, self).__init__(timeout=3600)
         self._robot = robot
         self._parent_msg = parent_msg  # type: discord.Message
@@ -22,12 +31,16 @@ class ResultView(discord.ui.View):
         self._result = result
         self._current_content = current_content
         self._current_attachments = current_attachments
+        self._current_image_keys = current_image_keys
+        self._btn_originals = []  # type: List[ActionButton]
 
         self._upscale_result = None
 
+        tracer = self._robot.get_tracer()
+
         # UI 控件
         self._btn_again = ActionButton(style=discord.ButtonStyle.green, label="再次施法")
-        self._btn_again.set_callback(self._on_again_clicked)
+        self._btn_again.set_callback(tracer.wrap_interaction("again", self._on_again_clicked))
         self.add_item(self._btn_again)
 
         self._btn_repaint = ActionButton(style=discord.ButtonStyle.blurple, label="施加变幻")
@@ -35,13 +48,60 @@ class ResultView(discord.ui.View):
         self.add_item(self._btn_repaint)
 
         self._btn_upscale_x2 = ActionButton(style=discord.ButtonStyle.blurple, label="x2")
-        self._btn_upscale_x2.set_callback(lambda i: self._on_upscale_clicked(i, 2))
+        self._btn_upscale_x2.set_callback(tracer.wrap_interaction("upscale", lambda i: self._on_upscale_clicked(i, 2)))
         self.add_item(self._btn_upscale_x2)
 
         self._btn_upscale_x3 = ActionButton(style=discord.ButtonStyle.blurple, label="x3")
-        self._btn_upscale_x3.set_callback(lambda i: self._on_upscale_clicked(i, 3))
+        self._btn_upscale_x3.set_callback(tracer.wrap_interaction("upscale", lambda i: self._on_upscale_clicked(i, 3)))
         self.add_item(self._btn_upscale_x3)
 
+        self._btn_hires = ActionButton(style=discord.ButtonStyle.blurple, label="精绘")
+        self._btn_hires.set_callback(tracer.wrap_interaction("hires", self._on_hires_clicked))
+        self.add_item(self._btn_hires)
+
+        self._refresh_original_buttons()
+
+        # 降级的结果允许在负载下降后以完整质量重试
+        self._btn_full_quality = None
+        if degraded:
+            self._btn_full_quality = ActionButton(style=discord.ButtonStyle.green, label="完整施法", row=2)
+            self._btn_full_quality.set_callback(tracer.wrap_interaction("full_quality", self._on_full_quality_clicked))
+            self.add_item(self._btn_full_quality)
+
+        # 标记活跃，供预取使用
+        self._robot.get_prefetcher().touch(self)
+
+    def get_reroll_request(self):
+        args = self._args.clone()
+        args.seed = None  # 此时 Seed 总是 None
+        return self._result_type, args
+
+    def _refresh_original_buttons(self):
+        # 预览模式下为每张图提供获取原图的按钮
+        for btn in self._btn_originals:
+            self.remove_item(btn)
+        self._btn_originals = []
+        if self._current_image_keys is None:
+            return
+        for i in range(0, min(len(self._current_image_keys), _MAX_ORIGINAL_BUTTONS)):
+            btn = ActionButton(style=discord.ButtonStyle.gray, label=f"原图 {i + 1}", row=1)
+            btn.set_callback(self._robot.get_tracer().wrap_interaction(
+                "original", self._make_original_callback(self._current_image_keys[i], i)))
+            self._btn_originals.append(btn)
+            self.add_item(btn)
+
+    def _make_original_callback(self, key: str, index: int):
+        async def on_original_clicked(interaction: discord.Interaction):
+            with span("discord.defer"):
+                await interaction.response.defer()
+            image = await self._robot.get_result_store().get(key)
+            if image is None:
+                await interaction.followup.send(content="原图已失效")
+                return
+            with span("discord.upload", count=1):
+                await interaction.followup.send(file=discord.File(fp=io.BytesIO(image), filename=f"{index + 1}.png"))
+        return on_original_clicked
+
     async def _refresh_parent_msg(self):
         # attachment 要重置
         if self._current_attachments is not None:
@@ -50,23 +110,54 @@ class ResultView(discord.ui.View):
         await self._parent_msg.edit(content=self._current_content, attachments=self._current_attachments, view=self)
 
     async def _on_again_clicked(self, interaction: discord.Interaction):
-        await interaction.response.defer()
+        with span("discord.defer"):
+            await interaction.response.defer()
 
-        # 在频道发送一条新消息
-        msg = await interaction.channel.send(content="施法准备中", reference=self._parent_msg)
+            # 在频道发送一条新消息
+            msg = await interaction.channel.send(content="施法准备中", reference=self._parent_msg)
+
+        # 优先使用预取的结果
+        result = await self._robot.get_prefetcher().take(self)
 
         if self._result_type == RESULT_TXT2IMG:
             # 交由 process_paint_command 处理
             args = self._args.clone()
             args.seed = None  # 此时 Seed 总是 None
             args.comment = make_comment_from_interaction(interaction)
-            await self._robot.process_paint_command(msg, args)
+            await self._robot.process_paint_command(msg, args, result)
         else:
             assert self._result_type == RESULT_IMG2IMG
             # 交由 process_repaint_command 处理
             args = self._args.clone()
             args.seed = None  # 此时 Seed 总是 None
             args.comment = make_comment_from_interaction(interaction)
+            await self._robot.process_repaint_command(msg, args, result=result)
+
+    async def _on_full_quality_clicked(self, interaction: discord.Interaction):
+        with span("discord.defer"):
+            await interaction.response.defer()
+
+            # 只允许重试一次
+            self.remove_item(self._btn_full_quality)
+            await self._refresh_parent_msg()
+
+            msg = await interaction.channel.send(content="等待魔力恢复", reference=self._parent_msg)
+
+        # 等待负载下降
+        with span("degrade.wait"):
+            idle = await self._robot.get_degrade_policy().wait_until_idle(self.is_finished)
+        if not idle:
+            await msg.edit(content="魔力迟迟未能恢复，施法取消")
+            return
+
+        args = self._args.clone()
+        args.seed = self._result.seed  # 以相同种子重绘，得到同一张图的完整质量版本
+        args.explicit_args.update(DEGRADABLE_ARGS)  # 不再降级
+        args.comment = make_comment_from_interaction(interaction)
+        if self._result_type == RESULT_TXT2IMG:
+            await self._robot.process_paint_command(msg, args)
+        else:
+            assert self._result_type == RESULT_IMG2IMG
             await self._robot.process_repaint_command(msg, args)
 
     async def _on_repaint_clicked(self, interaction: discord.Interaction):
@@ -82,11 +173,13 @@ class ResultView(discord.ui.View):
         await interaction.response.send_modal(RepaintModal(self._robot, args))
 
     async def _on_upscale_clicked(self, interaction: discord.Interaction, scale: int):
-        await interaction.response.defer()
+        with span("discord.defer"):
+            await interaction.response.defer()
 
         # 禁用按钮并刷新 UI
         self._btn_upscale_x2.disabled = True
         self._btn_upscale_x3.disabled = True
+        self._btn_hires.disabled = True
         if scale == 2:
             self._btn_upscale_x2.label = "处理中"
         else:
@@ -105,6 +198,7 @@ class ResultView(discord.ui.View):
             # 恢复按钮
             self._btn_upscale_x2.disabled = False
             self._btn_upscale_x3.disabled = False
+            self._btn_hires.disabled = False
             if scale == 2:
                 self._btn_upscale_x2.label = "x2"
             else:
@@ -113,7 +207,8 @@ class ResultView(discord.ui.View):
             return
 
         # 刷新 Attachment
-        attachments = images_to_attachments(self._upscale_result.images)
+        attachments, self._current_image_keys = await self._robot.make_result_attachments(self._upscale_result.images)
+        self._refresh_original_buttons()
 
         # 恢复按钮
         self._btn_upscale_x2.disabled = False
@@ -123,7 +218,70 @@ class ResultView(discord.ui.View):
         self.remove_item(self._btn_upscale_x2)  # 放大 3 倍的时候可以连 2 倍按钮一起消除
         if scale == 3:
             self.remove_item(self._btn_upscale_x3)
+        self.remove_item(self._btn_hires)  # 已上采样的结果不再精绘
 
         # 刷新消息
         self._current_attachments = attachments
+        with span("discord.upload", count=len(attachments)):
+            await self._refresh_parent_msg()
+
+    async def _on_hires_clicked(self, interaction: discord.Interaction):
+        with span("discord.defer"):
+            await interaction.response.defer()
+
+        # 禁用按钮并刷新 UI
+        self._btn_upscale_x2.disabled = True
+        self._btn_upscale_x3.disabled = True
+        self._btn_hires.disabled = True
+        self._btn_hires.label = "处理中"
         await self._refresh_parent_msg()
+
+        last_update = 0.
+        updating = False
+
+        async def on_progress_callback(progress):
+            # 多个分块并行完成，节流后只刷新按钮，不重新上传附件
+            nonlocal last_update, updating
+            self._btn_hires.label = "精绘：%.0f %%" % (progress * 100)
+            now = time.monotonic()
+            if updating or now - last_update < _PROGRESS_UPDATE_INTERVAL:
+                return
+            updating = True
+            last_update = now
+            try:
+                await self._parent_msg.edit(view=self)
+            finally:
+                updating = False
+
+        # 发起分块重绘操作
+        config = self._robot.get_config()
+        args = self._args.clone()
+        args.comment = make_comment_from_interaction(interaction)
+        try:
+            # 我们总是取第一张图
+            self._upscale_result = await tiled_hires(self._robot.get_sd_client(), args, self._result.images[0],
+                                                     config.hires_scale, config.hires_tile_overlap,
+                                                     config.hires_denoise, on_progress_callback)
+        except Exception:
+            logging.exception("Processing error")
+            # 恢复按钮
+            self._btn_upscale_x2.disabled = False
+            self._btn_upscale_x3.disabled = False
+            self._btn_hires.disabled = False
+            self._btn_hires.label = "精绘"
+            await self._refresh_parent_msg()
+            return
+
+        # 刷新 Attachment
+        attachments, self._current_image_keys = await self._robot.make_result_attachments(self._upscale_result.images)
+        self._refresh_original_buttons()
+
+        # 消除按钮，精绘后不再允许上采样
+        self.remove_item(self._btn_upscale_x2)
+        self.remove_item(self._btn_upscale_x3)
+        self.remove_item(self._btn_hires)
+
+        # 刷新消息
+        self._current_attachments = attachments
+        with span("discord.upload", count=len(attachments)):
+            await self._refresh_parent_msg()
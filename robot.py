@@ -1,21 +1,33 @@
 import io
 import os
+import asyncio
 import logging
 import discord
 from typing import List, Optional
 from PIL import Image
 from config import Config
-from sd_client import SDClient, SDProcessArguments
+from sd_client import SDClient, SDProcessArguments, SDProcessResult
 from result_view import ResultView, RESULT_TXT2IMG, RESULT_IMG2IMG
 from repaint_view import OpenRepaintModalView
+from tracing import Tracer, span
+from diagnostics import LoopWatchdog, sample_stacks, format_folded
+from result_store import ResultStore
+from prefetch import Prefetcher
+from degrade import DegradePolicy
 from utils import images_to_attachments, mix_negative_prompts, get_best_tensor_size, select_best_tensor_size, \
-    make_comment_from_interaction, make_comment_from_message
+    make_comment_from_interaction, make_comment_from_message, make_contact_sheet
 
 
 class Robot:
     def __init__(self, config: Config):
         self._config = config
 
+        # 请求追踪
+        self._tracer = Tracer(config)
+
+        # 事件循环监测
+        self._watchdog = LoopWatchdog(config)
+
         # 建立客户端
         self._client = discord.Client(intents=discord.Intents(messages=True, dm_messages=True),
                                       proxy=os.getenv("https_proxy", None))
@@ -36,30 +48,35 @@ class Robot:
         async def paint(interaction: discord.Interaction, prompts: str, size: Optional[str] = None,
                         negative: Optional[str] = None, scale: Optional[float] = None, seed: Optional[int] = None,
                         module: Optional[str] = None, steps: Optional[int] = None):
-            if size is None:
-                size = "portrait"
-
-            # 设置参数
-            args = SDProcessArguments()
-            args.width, args.height = get_best_tensor_size(size)
-            args.prompts = prompts
-            args.negative_prompts = "$" if negative is None else negative  # 使用默认值替换
-            args.module = module
-            args.comment = make_comment_from_interaction(interaction)
-            if steps is not None:
-                args.steps = steps
-            if scale is not None:
-                args.scale = scale
-            if seed is not None and seed >= 0:
-                args.seed = seed
-            args.limit_args_range()
-
-            # 通知稍后处理
-            await interaction.response.defer()
-            wb_msg = await interaction.followup.send(content="施法准备中")  # type: discord.WebhookMessage
-
-            # 发起后继请求
-            await self.process_paint_command(wb_msg, args)
+            with self._tracer.trace("paint", user_id=interaction.user.id):
+                # 设置参数
+                args = SDProcessArguments()
+                if size is None:
+                    size = "portrait"
+                else:
+                    args.explicit_args.add("size")
+
+                args.width, args.height = get_best_tensor_size(size)
+                args.prompts = prompts
+                args.negative_prompts = "$" if negative is None else negative  # 使用默认值替换
+                args.module = module
+                args.comment = make_comment_from_interaction(interaction)
+                if steps is not None:
+                    args.steps = steps
+                    args.explicit_args.add("steps")
+                if scale is not None:
+                    args.scale = scale
+                if seed is not None and seed >= 0:
+                    args.seed = seed
+                args.limit_args_range()
+
+                # 通知稍后处理
+                with span("discord.defer"):
+                    await interaction.response.defer()
+                    wb_msg = await interaction.followup.send(content="施法准备中")  # type: discord.WebhookMessage
+
+                # 发起后继请求
+                await self.process_paint_command(wb_msg, args)
 
         @paint.autocomplete("size")
         async def paint_size_autocomplete(interaction: discord.Interaction, current: str) \
@@ -76,9 +93,48 @@ class Robot:
             return [discord.app_commands.Choice(name=v, value=v)
                     for v in self._config.available_modules if v.find(current) >= 0]
 
+        # /profile
+        @self._command_tree.command(name="profile", description="对事件循环进行采样分析（仅限管理员）")
+        async def profile(interaction: discord.Interaction, seconds: Optional[int] = None):
+            if interaction.user.id not in self._config.admin_user_ids:
+                await interaction.response.send_message(content="权限不足", ephemeral=True)
+                return
+            if seconds is None:
+                seconds = 10
+            seconds = max(1, min(seconds, self._config.profile_max_seconds))
+
+            await interaction.response.defer(ephemeral=True)
+
+            # 在线程中采样，事件循环保持运行
+            loop = asyncio.get_event_loop()
+            stacks = await loop.run_in_executor(None, sample_stacks, self._watchdog.get_loop_thread_id(), seconds,
+                                                self._config.profile_sample_interval)
+            folded = format_folded(stacks).encode("utf-8")
+            content = f"采样 {seconds} 秒，{sum(stacks.values())} 个样本。{self._watchdog.get_stats_text()}"
+            await interaction.followup.send(content=content, ephemeral=True,
+                                            file=discord.File(fp=io.BytesIO(folded), filename="profile.folded"))
+
+        # /stats
+        @self._command_tree.command(name="stats", description="查看运行状态（仅限管理员）")
+        async def stats(interaction: discord.Interaction):
+            if interaction.user.id not in self._config.admin_user_ids:
+                await interaction.response.send_message(content="权限不足", ephemeral=True)
+                return
+            content = f"{self._watchdog.get_stats_text()}\n{self._prefetcher.get_stats_text()}"
+            await interaction.response.send_message(content=content, ephemeral=True)
+
         # SD 客户端
         self._sd_client = SDClient(config)
 
+        # 再次施法的预取
+        self._prefetcher = Prefetcher(config, self._sd_client, self._tracer)
+
+        # 过载降级
+        self._degrade_policy = DegradePolicy(config, self._sd_client)
+
+        # 预览模式下的结果仓库
+        self._result_store = ResultStore(config) if config.preview_mode else None
+
     async def _on_ready(self):
         logging.info("Prepare to sync commands")
         await self._command_tree.sync()
@@ -107,7 +163,8 @@ class Robot:
 
         # AppCommand 不能支持增加附件，因此我们通过 at 机器人的方式完成 img2img 初始图片的捕获
         if clean_message.startswith("/repaint"):
-            await self._on_repaint_message(message, clean_message[len("/repaint"):])
+            with self._tracer.trace("repaint", user_id=message.author.id):
+                await self._on_repaint_message(message, clean_message[len("/repaint"):])
 
     async def _on_repaint_message(self, message: discord.Message, clean_message: str):
         if len(message.attachments) == 0:
@@ -131,7 +188,8 @@ class Robot:
             return
 
         # 读取附件
-        image = await message.attachments[0].read(use_cached=True)  # 我们总是取第一张图
+        with span("discord.download"):
+            image = await message.attachments[0].read(use_cached=True)  # 我们总是取第一张图
         args.images = [image]
 
         # 决定图片采用的方向/大小
@@ -151,61 +209,114 @@ class Robot:
             view = OpenRepaintModalView(self, args)
             await message.channel.send(content="施法需要足够的魔素", view=view, reference=message)
         else:
-            wb_msg = await message.channel.send(content="施法准备中", reference=message)
+            with span("discord.reply"):
+                wb_msg = await message.channel.send(content="施法准备中", reference=message)
             await self.process_repaint_command(wb_msg, args, False)
 
+    def get_config(self):
+        return self._config
+
+    def get_tracer(self):
+        return self._tracer
+
     def get_sd_client(self):
         return self._sd_client
 
+    def get_prefetcher(self):
+        return self._prefetcher
+
+    def get_degrade_policy(self):
+        return self._degrade_policy
+
+    def get_result_store(self):
+        return self._result_store
+
+    async def make_result_attachments(self, images: List[bytes]):
+        # 预览模式下只上传一张拼合的缩略图，原图存入结果仓库，返回仓库中的 key 供按需取用
+        with span("discord.attachments", count=len(images), preview=self._result_store is not None):
+            if self._result_store is None:
+                return images_to_attachments(images), None
+
+            keys = await self._result_store.put(images)
+            sheet = await asyncio.get_event_loop().run_in_executor(None, make_contact_sheet, images,
+                                                                   self._config.preview_thumb_size,
+                                                                   self._config.preview_quality)
+            return [discord.File(fp=io.BytesIO(sheet), filename="preview.jpg")], keys
+
     async def run(self):
+        self._tracer.start()
+        self._watchdog.start()
+        self._prefetcher.start()
         await self._client.start(self._config.bot_token)
 
-    async def process_paint_command(self, base_msg: discord.Message, args: SDProcessArguments):
+    async def process_paint_command(self, base_msg: discord.Message, args: SDProcessArguments,
+                                    result: Optional[SDProcessResult] = None):
         # 统一处理负面关键词
         args.negative_prompts = mix_negative_prompts(args.negative_prompts, self._config.default_negative_prompts)
 
-        # 发起操作
+        # 过载时降低未指定的参数，预取的结果不做降级
+        run_args = args
+        degrade_note = None
+        if result is None:
+            run_args = args.clone()
+            degrade_note = self._degrade_policy.apply(run_args)
+
+        # 发起操作，已有预取结果时跳过
         try:
             async def on_progress_callback(progress):
                 await base_msg.edit(content="吟唱：%.2f %%" % (progress * 100))
 
-            result = await self._sd_client.txt2img(args, on_progress=on_progress_callback)
+            if result is None:
+                result = await self._sd_client.txt2img(run_args, on_progress=on_progress_callback, foreground=True)
         except Exception as ex:
             logging.exception("Processing error")
             await base_msg.edit(content=f"{ex}")
             return
 
         # 完成，转换到文件
-        attachments = images_to_attachments(result.images)
+        attachments, image_keys = await self.make_result_attachments(result.images)
 
         # 消息部分
-        content = f"DDIM，种子：{result.seed}，步长：{args.steps}，CFG Scale：{args.scale}"
+        content = f"DDIM，种子：{result.seed}，步长：{run_args.steps}，CFG Scale：{args.scale}"
         if args.module is not None:
             content += f"，模组：{args.module}"
+        if degrade_note is not None:
+            content += f"\n负载过高，已降级：{degrade_note}"
 
         # 控制视图
-        view = ResultView(self, base_msg, RESULT_TXT2IMG, args, result, content, attachments)
+        view = ResultView(self, base_msg, RESULT_TXT2IMG, args, result, content, attachments, image_keys,
+                          degrade_note is not None)
 
         # 回复
-        await base_msg.edit(content=content, attachments=attachments, view=view)
+        with span("discord.upload", count=len(attachments)):
+            await base_msg.edit(content=content, attachments=attachments, view=view)
 
-    async def process_repaint_command(self, base_msg: discord.Message, args: SDProcessArguments, show_prompts=False):
+    async def process_repaint_command(self, base_msg: discord.Message, args: SDProcessArguments, show_prompts=False,
+                                      result: Optional[SDProcessResult] = None):
         # 统一处理负面关键词
         args.negative_prompts = mix_negative_prompts(args.negative_prompts, self._config.default_negative_prompts)
 
-        # 发起操作
+        # 过载时降低未指定的参数，预取的结果不做降级
+        run_args = args
+        degrade_note = None
+        if result is None:
+            run_args = args.clone()
+            degrade_note = self._degrade_policy.apply(run_args)
+
+        # 发起操作，已有预取结果时跳过
         try:
             async def on_progress_callback(progress):
                 await base_msg.edit(content="吟唱：%.2f %%" % (progress * 100))
 
-            result = await self._sd_client.img2img(args, on_progress=on_progress_callback)
+            if result is None:
+                result = await self._sd_client.img2img(run_args, on_progress=on_progress_callback, foreground=True)
         except Exception as ex:
             logging.exception("Processing error")
             await base_msg.edit(content=f"{ex}")
             return
 
         # 完成，转换到文件
-        attachments = images_to_attachments(result.images)
+        attachments, image_keys = await self.make_result_attachments(result.images)
 
         # 消息部分
         content_lines = []
@@ -215,14 +326,18 @@ class Robot:
             if args.negative_prompts != self._config.default_negative_prompts:
                 content_lines.append(f"Negative prompts: {args.negative_prompts}")
             content_lines.append("```")
-        content_lines.append(f"DDIM，种子：{result.seed}，步长：{args.steps}，CFG Scale：{args.scale}，"
+        content_lines.append(f"DDIM，种子：{result.seed}，步长：{run_args.steps}，CFG Scale：{args.scale}，"
                              f"Denoise：{args.denoise}")
         if args.module is not None:
             content_lines[len(content_lines) - 1] += f"，模组：{args.module}"
+        if degrade_note is not None:
+            content_lines.append(f"负载过高，已降级：{degrade_note}")
         content = "\n".join(content_lines)
 
         # 控制视图
-        view = ResultView(self, base_msg, RESULT_IMG2IMG, args, result, content, attachments)
+        view = ResultView(self, base_msg, RESULT_IMG2IMG, args, result, content, attachments, image_keys,
+                          degrade_note is not None)
 
         # 回复
-        await base_msg.edit(content=content, attachments=attachments, view=view)
+        with span("discord.upload", count=len(attachments)):
+            await base_msg.edit(content=content, attachments=attachments, view=view)
@@ -2,13 +2,18 @@ import re
 import zlib
 import json
 import math
+import time
 import asyncio
 import base64
+import hashlib
+import contextlib
 import logging
 import aiohttp
 import aiohttp.client_exceptions
-from typing import Optional, List
+from typing import Optional, List, Set
+from collections import OrderedDict
 from config import Config
+import tracing
 
 
 _COMMON_ARG_REGEX = re.compile(r"\s*(prompts|negative|resize|seed|scale|module|steps|denoise)\s*:\s*((.(?!prompts\s*:"
@@ -49,6 +54,7 @@ class SDProcessArguments:
         self.seed: Optional[int] = None
         self.module: Optional[str] = None
         self.comment: Optional[str] = None
+        self.explicit_args: Set[str] = set()  # 用户明确指定的参数，降级时不做调整
 
     def from_common_args(self, args: str):
         raw_args = {}
@@ -75,6 +81,8 @@ class SDProcessArguments:
         self.resize_mode = int(raw_args.get("resize", "2"))
         self.seed = int(raw_args["seed"]) if "seed" in raw_args else None
         self.module = raw_args.get("module", None)
+        if "steps" in raw_args:
+            self.explicit_args.add("steps")
         self.limit_args_range()
 
     def limit_args_range(self):
@@ -98,16 +106,19 @@ class SDProcessArguments:
         ret.seed = self.seed
         ret.module = self.module
         ret.comment = self.comment
+        ret.explicit_args = set(self.explicit_args)
         return ret
 
 
 class SDProcessResult:
-    def __init__(self, task_id: int, width: int, height: int, images: List[bytes], seed: Optional[int] = None):
+    def __init__(self, task_id: int, width: int, height: int, images: List[bytes], seed: Optional[int] = None,
+                 run_time: Optional[float] = None):
         self.task_id = task_id
         self.width = width
         self.height = height
         self.images = images
         self.seed = seed
+        self.run_time = run_time  # 节点上的执行时间（秒），由轮询观测得到
 
 
 class SDClient:
@@ -115,27 +126,86 @@ class SDClient:
         self._config = config
         self._session = aiohttp.ClientSession(self._config.sd_api_base_url,
                                               headers={"X-API-SECRET": self._config.sd_api_secret})
+        self._inflight = 0
+        self._foreground_inflight = 0  # 用户直接发起的 paint/repaint 任务
+        self._avg_latency = 0.
+        self._image_index = OrderedDict()  # sd_work_manager 已持有的图片 sha256
 
-    async def _call(self, service: str, method: str, payload, timeout=300):
-        data = json.dumps(payload).encode('utf-8')
-        headers = {"Content-Type": "application/json"}
-        if len(data) > 4096:
-            data = zlib.compress(data)
-            headers["Content-Encoding"] = "deflate"
-
-        async with self._session.post(f"{self._config.sd_api_prefix}/{service}/{method}", data=data, headers=headers,
-                                      timeout=timeout) as resp:
-            r = await resp.json()
-            if r["code"] != 0:
-                raise RuntimeError(f"API Error: {r['msg']} ({r['code']})")
-            return r["data"]
-
-    async def _check_task(self, task_id: int, on_progress=None):
+    def get_inflight_count(self, foreground_only=False):
+        # 已提交但尚未完成的任务数
+        return self._foreground_inflight if foreground_only else self._inflight
+
+    def get_avg_latency(self):
+        # 用户直接发起的任务从提交到完成的平均耗时（秒）
+        return self._avg_latency
+
+    async def _call(self, service: str, method: str, payload, timeout=300, traced=True):
+        with tracing.span(f"sd.{service}.{method}") if traced else contextlib.nullcontext():
+            data = json.dumps(payload).encode('utf-8')
+            headers = {"Content-Type": "application/json"}
+            if len(data) > 4096:
+                data = zlib.compress(data)
+                headers["Content-Encoding"] = "deflate"
+            traceparent = tracing.make_traceparent()
+            if traceparent is not None:
+                headers["traceparent"] = traceparent
+
+            async with self._session.post(f"{self._config.sd_api_prefix}/{service}/{method}", data=data,
+                                          headers=headers, timeout=timeout) as resp:
+                r = await resp.json()
+                if r["code"] != 0:
+                    raise RuntimeError(f"API Error: {r['msg']} ({r['code']})")
+                return r["data"]
+
+    def _remember_images(self, images: List[bytes]):
+        if not self._config.sd_api_image_refs:
+            return
+        for img in images:
+            self._remember_hash(hashlib.sha256(img).hexdigest())
+
+    def _remember_hash(self, h: str):
+        self._image_index[h] = True
+        self._image_index.move_to_end(h)
+        while len(self._image_index) > self._config.image_index_max_entries:
+            self._image_index.popitem(last=False)
+
+    def _forget_images(self, images: List[bytes]):
+        for img in images:
+            self._image_index.pop(hashlib.sha256(img).hexdigest(), None)
+
+    def _resolve_image_refs(self, images: List[bytes]) -> Optional[List[str]]:
+        # 全部图片都在本地索引中时才转换为内容引用，否则返回 None 由调用方直接传输
+        hashes = [hashlib.sha256(x).hexdigest() for x in images]
+        if any([h not in self._image_index for h in hashes]):
+            return None
+        for h in hashes:
+            self._image_index.move_to_end(h)
+        return [f"sha256:{h}" for h in hashes]
+
+    async def _check_task(self, task_id: int, on_progress=None, foreground=False):
+        self._inflight += 1
+        if foreground:
+            self._foreground_inflight += 1
+        try:
+            begin = time.monotonic()
+            ret = await self._wait_task(task_id, on_progress)
+            if foreground:
+                self._avg_latency = self._avg_latency * 0.8 + (time.monotonic() - begin) * 0.2
+            return ret
+        finally:
+            self._inflight -= 1
+            if foreground:
+                self._foreground_inflight -= 1
+
+    async def _wait_task(self, task_id: int, on_progress=None):
         retry = 0
         last_status = -1
+        submit_ns = time.time_ns()
+        running_ns = None
         while True:
             try:
-                state = await self._call("Task", "getTaskState", {"taskId": task_id}, timeout=180)
+                # 轮询请求本身不单独记录 Span，排队和执行阶段在状态变化时补录
+                state = await self._call("Task", "getTaskState", {"taskId": task_id}, timeout=180, traced=False)
             except (aiohttp.client_exceptions.ClientConnectionError,
                     aiohttp.client_exceptions.ClientPayloadError,
                     asyncio.TimeoutError) as ex:
@@ -151,6 +221,12 @@ class SDClient:
             if status != last_status:
                 retry = 0
                 last_status = status
+                now_ns = time.time_ns()
+                if status in (1, 2, 3) and running_ns is None:
+                    tracing.record_span("manager.queue", submit_ns, now_ns, task_id=task_id)
+                    running_ns = now_ns
+                if status in (2, 3):
+                    tracing.record_span("node.run", running_ns, now_ns, task_id=task_id)
 
             if status == 0:  # pending
                 await asyncio.sleep(5)
@@ -159,11 +235,11 @@ class SDClient:
                     await on_progress(state["progress"])
                 await asyncio.sleep(2)
             if status == 2:  # finished
-                return state
+                return state, (time.time_ns() - running_ns) / 1e9
             elif status == 3:  # error
                 raise RuntimeError(f"Task Error: {state['errMsg']}")
 
-    async def img2img(self, args: SDProcessArguments, on_progress=None):
+    async def img2img(self, args: SDProcessArguments, on_progress=None, foreground=False):
         payload = {
             "width": args.width,
             "height": args.height,
@@ -177,14 +253,30 @@ class SDClient:
             "comment": args.comment,
             "denoise": args.denoise,
             "resizeMode": args.resize_mode,
-            "initialImages": bytes_to_b64(args.images),
         }
-        task_id = await self._call("Task", "submitImg2ImgTask", payload)
-        ret = await self._check_task(task_id, on_progress)
-        return SDProcessResult(task_id, ret["resultWidth"], ret["resultHeight"], b64_to_bytes(ret["resultImages"]),
-                               ret["resultSeed"])
 
-    async def txt2img(self, args: SDProcessArguments, on_progress=None):
+        # 优先按内容引用传递初始图片
+        refs = self._resolve_image_refs(args.images) if self._config.sd_api_image_refs else None
+        if refs is not None:
+            payload["initialImageRefs"] = refs
+            try:
+                task_id = await self._call("Task", "submitImg2ImgTask", payload)
+            except RuntimeError:
+                # 本地索引可能已经过时，改为直接传输
+                logging.exception("Submit with image references failed")
+                self._forget_images(args.images)
+                del payload["initialImageRefs"]
+                refs = None
+        if refs is None:
+            payload["initialImages"] = bytes_to_b64(args.images)
+            task_id = await self._call("Task", "submitImg2ImgTask", payload)
+        ret, run_time = await self._check_task(task_id, on_progress, foreground)
+        with tracing.span("sd.decode"):
+            images = b64_to_bytes(ret["resultImages"])
+        self._remember_images(images)  # 结果图片由 sd_work_manager 产生，对方一定持有
+        return SDProcessResult(task_id, ret["resultWidth"], ret["resultHeight"], images, ret["resultSeed"], run_time)
+
+    async def txt2img(self, args: SDProcessArguments, on_progress=None, foreground=False):
         payload = {
             "width": args.width,
             "height": args.height,
@@ -198,9 +290,11 @@ class SDClient:
             "comment": args.comment,
         }
         task_id = await self._call("Task", "submitTxt2ImgTask", payload)
-        ret = await self._check_task(task_id, on_progress)
-        return SDProcessResult(task_id, ret["resultWidth"], ret["resultHeight"], b64_to_bytes(ret["resultImages"]),
-                               ret["resultSeed"])
+        ret, run_time = await self._check_task(task_id, on_progress, foreground)
+        with tracing.span("sd.decode"):
+            images = b64_to_bytes(ret["resultImages"])
+        self._remember_images(images)  # 结果图片由 sd_work_manager 产生，对方一定持有
+        return SDProcessResult(task_id, ret["resultWidth"], ret["resultHeight"], images, ret["resultSeed"], run_time)
 
     async def upscale(self, image: bytes, scale: float, comment: Optional[str]):
         assert 1 < scale <= 4
@@ -211,5 +305,8 @@ class SDClient:
             "comment": comment,
         }
         task_id = await self._call("Task", "submitUpscaleTask", payload)
-        ret = await self._check_task(task_id, None)
-        return SDProcessResult(task_id, ret["resultWidth"], ret["resultHeight"], b64_to_bytes(ret["resultImages"]))
+        ret, run_time = await self._check_task(task_id, None)
+        with tracing.span("sd.decode"):
+            images = b64_to_bytes(ret["resultImages"])
+        self._remember_images(images)  # 结果图片由 sd_work_manager 产生，对方一定持有
+        return SDProcessResult(task_id, ret["resultWidth"], ret["resultHeight"], images, None, run_time)
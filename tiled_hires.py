@@ -0,0 +1,144 @@
+import io
+import asyncio
+import logging
+from typing import List, Tuple
+from PIL import Image, ImageChops, ImageDraw
+from sd_client import SDClient, SDProcessArguments, SDProcessResult
+from utils import select_best_tensor_size
+
+
+class _Tile:
+    def __init__(self, x: int, y: int, width: int, height: int, left_overlap: int, top_overlap: int):
+        self.x = x
+        self.y = y
+        self.width = width
+        self.height = height
+        self.left_overlap = left_overlap  # 与左侧分块重叠的像素数
+        self.top_overlap = top_overlap  # 与上方分块重叠的像素数
+
+
+def _align_to_block(v: int) -> int:
+    return max(64, -(-v // 64) * 64)
+
+
+def _split_axis(length: int, tile: int, overlap: int) -> List[int]:
+    if length <= tile:
+        return [0]
+
+    # 在满足最小重叠的前提下均匀分布分块
+    count = -(-(length - overlap) // (tile - overlap))
+    count = max(2, count)
+    return [round(i * (length - tile) / (count - 1)) for i in range(0, count)]
+
+
+def _layout_tiles(width: int, height: int, tile_width: int, tile_height: int, overlap: int) -> List[_Tile]:
+    tile_width = min(tile_width, width)
+    tile_height = min(tile_height, height)
+    overlap = min(overlap, tile_width // 2, tile_height // 2)
+    xs = _split_axis(width, tile_width, overlap)
+    ys = _split_axis(height, tile_height, overlap)
+
+    tiles = []
+    for j in range(0, len(ys)):
+        for i in range(0, len(xs)):
+            left_overlap = 0 if i == 0 else xs[i - 1] + tile_width - xs[i]
+            top_overlap = 0 if j == 0 else ys[j - 1] + tile_height - ys[j]
+            tiles.append(_Tile(xs[i], ys[j], tile_width, tile_height, left_overlap, top_overlap))
+    return tiles
+
+
+def _make_blend_mask(tile: _Tile) -> Image.Image:
+    # 在与已贴上的分块重叠的区域做线性过渡，消除接缝
+    mask = Image.new("L", (tile.width, tile.height), 255)
+    if tile.left_overlap > 0:
+        ramp = Image.new("L", (tile.width, tile.height), 255)
+        draw = ImageDraw.Draw(ramp)
+        for i in range(0, tile.left_overlap):
+            draw.line([(i, 0), (i, tile.height - 1)], fill=int(255 * (i + 1) / (tile.left_overlap + 1)))
+        mask = ImageChops.multiply(mask, ramp)
+    if tile.top_overlap > 0:
+        ramp = Image.new("L", (tile.width, tile.height), 255)
+        draw = ImageDraw.Draw(ramp)
+        for i in range(0, tile.top_overlap):
+            draw.line([(0, i), (tile.width - 1, i)], fill=int(255 * (i + 1) / (tile.top_overlap + 1)))
+        mask = ImageChops.multiply(mask, ramp)
+    return mask
+
+
+def _image_to_png(img: Image.Image) -> bytes:
+    with io.BytesIO() as fp:
+        img.save(fp, format="PNG")
+        return fp.getvalue()
+
+
+def _split_image(image: bytes, overlap: int) -> Tuple[int, int, List[_Tile], List[bytes]]:
+    with io.BytesIO(image) as fp:
+        img = Image.open(fp)
+        img.load()
+    img = img.convert("RGB")
+
+    # 分块大小由显存上限决定
+    tile_width, tile_height = select_best_tensor_size(img.size[0], img.size[1])
+    tiles = _layout_tiles(img.size[0], img.size[1], tile_width, tile_height, overlap)
+    tile_images = [_image_to_png(img.crop((t.x, t.y, t.x + t.width, t.y + t.height))) for t in tiles]
+    return img.size[0], img.size[1], tiles, tile_images
+
+
+def _stitch_tiles(width: int, height: int, tiles: List[_Tile], tile_images: List[bytes]) -> bytes:
+    canvas = Image.new("RGB", (width, height))
+    for i in range(0, len(tiles)):
+        t = tiles[i]
+        with io.BytesIO(tile_images[i]) as fp:
+            img = Image.open(fp)
+            img.load()
+        img = img.convert("RGB")
+        if img.size != (t.width, t.height):
+            img = img.resize((t.width, t.height), Image.LANCZOS)
+        canvas.paste(img, (t.x, t.y), _make_blend_mask(t))
+    return _image_to_png(canvas)
+
+
+async def tiled_hires(sd_client: SDClient, args: SDProcessArguments, image: bytes, scale: float, overlap: int,
+                      denoise: float, on_progress=None) -> SDProcessResult:
+    """
+    分块高清重绘
+
+    先通过上采样放大底图，再将其切分为显存允许的重叠分块，每个分块作为独立的 img2img 任务提交，
+    由 sd_work_manager 分发到各个节点并行处理，最后羽化拼接。
+    """
+    loop = asyncio.get_event_loop()
+
+    # 放大底图
+    base = await sd_client.upscale(image, scale, args.comment)
+
+    # 切块（图像编解码放到线程池，避免阻塞事件循环）
+    width, height, tiles, tile_images = await loop.run_in_executor(None, _split_image, base.images[0], overlap)
+    logging.info(f"Tiled hires {width}x{height}, {len(tiles)} tiles")
+
+    finished = 0
+
+    async def process_tile(tile: _Tile, tile_image: bytes) -> bytes:
+        nonlocal finished
+        tile_args = args.clone()
+        # 分块通常已对齐到 64，按原尺寸重绘；仅当图片边长不足一个分块时才需要缩放
+        tile_args.width, tile_args.height = _align_to_block(tile.width), _align_to_block(tile.height)
+        tile_args.images = [tile_image]
+        tile_args.count = 1
+        tile_args.denoise = denoise
+        tile_args.resize_mode = 0
+        ret = await sd_client.img2img(tile_args)
+        finished += 1
+        if on_progress is not None:
+            await on_progress(finished / len(tiles))
+        return ret.images[0]
+
+    # 等待所有分块结束后再报告错误，避免调用方在仍有分块运行时重试
+    results = await asyncio.gather(*[process_tile(tiles[i], tile_images[i]) for i in range(0, len(tiles))],
+                                   return_exceptions=True)
+    for r in results:
+        if isinstance(r, BaseException):
+            raise r
+
+    # 拼接
+    output = await loop.run_in_executor(None, _stitch_tiles, width, height, tiles, list(results))
+    return SDProcessResult(base.task_id, width, height, [output], args.seed)
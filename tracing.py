@@ -0,0 +1,234 @@
+import os
+import json
+import time
+import random
+import asyncio
+import logging
+import contextlib
+import contextvars
+import aiohttp
+from typing import Optional, List, Dict
+from config import Config
+
+
+_current_span: contextvars.ContextVar[Optional["Span"]] = contextvars.ContextVar("current_span", default=None)
+
+
+def _new_id(n: int) -> str:
+    return os.urandom(n).hex()
+
+
+def _to_otlp_value(v):
+    if isinstance(v, bool):
+        return {"boolValue": v}
+    elif isinstance(v, int):
+        return {"intValue": str(v)}
+    elif isinstance(v, float):
+        return {"doubleValue": v}
+    return {"stringValue": str(v)}
+
+
+class Span:
+    def __init__(self, tracer: "Tracer", trace_id: str, parent_id: Optional[str], name: str, sampled: bool,
+                 start_ns: Optional[int] = None):
+        self.tracer = tracer
+        self.trace_id = trace_id
+        self.span_id = _new_id(8)
+        self.parent_id = parent_id
+        self.name = name
+        self.sampled = sampled
+        self.start_ns = time.time_ns() if start_ns is None else start_ns
+        self.end_ns: Optional[int] = None
+        self.attributes: Dict[str, object] = {}
+        self.error: Optional[str] = None
+
+    def set_attribute(self, key: str, value):
+        self.attributes[key] = value
+
+    def end(self, end_ns: Optional[int] = None):
+        if self.end_ns is not None:
+            return
+        self.end_ns = time.time_ns() if end_ns is None else end_ns
+        if self.sampled:
+            self.tracer.on_span_end(self)
+
+    def to_dict(self):
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start_ns": self.start_ns,
+            "end_ns": self.end_ns,
+            "duration_ms": (self.end_ns - self.start_ns) / 1e6,
+            "attributes": self.attributes,
+            "error": self.error,
+        }
+
+    def to_otlp(self):
+        ret = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": 1,  # SPAN_KIND_INTERNAL
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns),
+            "attributes": [{"key": k, "value": _to_otlp_value(v)} for k, v in self.attributes.items()],
+        }
+        if self.parent_id is not None:
+            ret["parentSpanId"] = self.parent_id
+        if self.error is not None:
+            ret["status"] = {"code": 2, "message": self.error}  # STATUS_CODE_ERROR
+        return ret
+
+
+class Tracer:
+    """
+    请求追踪
+
+    在入口处创建 Trace，通过 contextvars 在协程间传递当前 Span。结束的 Span 暂存在内存中，
+    由后台任务按批导出到本地文件（JSON Lines）或 OTLP/HTTP 兼容的收集器，不阻塞事件循环。
+    """
+    def __init__(self, config: Config):
+        self._config = config
+        self._pending: List[Span] = []
+        self._flush_event = asyncio.Event()
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def enabled(self):
+        return self._config.trace_sample_rate > 0 and \
+            (self._config.trace_export_file is not None or self._config.trace_otlp_endpoint is not None)
+
+    @contextlib.contextmanager
+    def trace(self, name: str, **attributes):
+        """
+        开启一个新的 Trace，并将根 Span 设为当前 Span
+        """
+        sampled = self.enabled() and random.random() < self._config.trace_sample_rate
+        root = Span(self, _new_id(16), None, name, sampled)
+        for k, v in attributes.items():
+            root.set_attribute(k, v)
+        with _enter_span(root):
+            yield root
+
+    def wrap_interaction(self, name: str, cb):
+        """
+        包装交互回调，使每次回调处于一个独立的 Trace 中
+        """
+        async def wrapper(interaction):
+            with self.trace(name, user_id=interaction.user.id):
+                await cb(interaction)
+        return wrapper
+
+    def on_span_end(self, s: Span):
+        if len(self._pending) >= self._config.trace_max_pending_spans:
+            return  # 导出跟不上时直接丢弃
+        self._pending.append(s)
+        if len(self._pending) >= self._config.trace_batch_size:
+            self._flush_event.set()
+
+    def start(self):
+        if self.enabled() and self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_event.wait(), self._config.trace_flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_event.clear()
+            if len(self._pending) == 0:
+                continue
+
+            batch = self._pending
+            self._pending = []
+            try:
+                await self._export(batch)
+            except Exception:
+                logging.exception("Export spans failed")
+
+    async def _export(self, batch: List[Span]):
+        if self._config.trace_export_file is not None:
+            lines = "".join([json.dumps(s.to_dict(), ensure_ascii=False) + "\n" for s in batch])
+            await asyncio.get_event_loop().run_in_executor(None, self._write_file, lines)
+
+        if self._config.trace_otlp_endpoint is not None:
+            if self._session is None:
+                self._session = aiohttp.ClientSession()
+            payload = {
+                "resourceSpans": [{
+                    "resource": {
+                        "attributes": [{"key": "service.name", "value": {"stringValue": "ai_painting_bot"}}],
+                    },
+                    "scopeSpans": [{
+                        "scope": {"name": "ai_painting_bot"},
+                        "spans": [s.to_otlp() for s in batch],
+                    }],
+                }],
+            }
+            async with self._session.post(self._config.trace_otlp_endpoint, json=payload, timeout=30) as resp:
+                if resp.status >= 300:
+                    logging.warning(f"OTLP collector responded {resp.status}")
+
+    def _write_file(self, lines: str):
+        with open(self._config.trace_export_file, "a", encoding="utf-8") as fp:
+            fp.write(lines)
+
+
+@contextlib.contextmanager
+def _enter_span(s: Span):
+    token = _current_span.set(s)
+    try:
+        yield s
+    except BaseException as ex:
+        s.error = f"{type(ex).__name__}: {ex}"
+        raise
+    finally:
+        _current_span.reset(token)
+        s.end()
+
+
+@contextlib.contextmanager
+def span(name: str, **attributes):
+    """
+    在当前 Trace 下开启一个子 Span，不在 Trace 中时什么也不做
+    """
+    parent = _current_span.get()
+    if parent is None:
+        yield None
+        return
+    s = Span(parent.tracer, parent.trace_id, parent.span_id, name, parent.sampled)
+    for k, v in attributes.items():
+        s.set_attribute(k, v)
+    with _enter_span(s):
+        yield s
+
+
+def record_span(name: str, start_ns: int, end_ns: int, **attributes):
+    """
+    补录一个已经结束的子 Span，用于记录通过轮询观测到的阶段
+    """
+    parent = _current_span.get()
+    if parent is None or not parent.sampled:
+        return
+    s = Span(parent.tracer, parent.trace_id, parent.span_id, name, parent.sampled, start_ns)
+    for k, v in attributes.items():
+        s.set_attribute(k, v)
+    s.end(end_ns)
+
+
+def current_trace_id() -> Optional[str]:
+    s = _current_span.get()
+    return None if s is None else s.trace_id
+
+
+def make_traceparent() -> Optional[str]:
+    """
+    生成 W3C traceparent 头
+    """
+    s = _current_span.get()
+    if s is None:
+        return None
+    return f"00-{s.trace_id}-{s.span_id}-{'01' if s.sampled else '00'}"
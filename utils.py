@@ -1,8 +1,11 @@
 import io
 import re
 import json
+import math
 import discord.ui
 from typing import List, Optional
+from PIL import Image
+from tracing import current_trace_id
 
 
 def images_to_attachments(images: List[bytes]) -> List[discord.File]:
@@ -17,6 +20,30 @@ def images_to_attachments(images: List[bytes]) -> List[discord.File]:
     return attachments
 
 
+def make_contact_sheet(images: List[bytes], thumb_size: int, quality: int) -> bytes:
+    # 将所有图片缩略后拼成网格，输出 JPEG
+    thumbs = []
+    for img in images:
+        with io.BytesIO(img) as fp:
+            t = Image.open(fp)
+            t.load()
+        t = t.convert("RGB")
+        t.thumbnail((thumb_size, thumb_size), Image.LANCZOS)
+        thumbs.append(t)
+
+    columns = math.ceil(math.sqrt(len(thumbs)))
+    rows = math.ceil(len(thumbs) / columns)
+    cell_width = max([t.size[0] for t in thumbs])
+    cell_height = max([t.size[1] for t in thumbs])
+    sheet = Image.new("RGB", (cell_width * columns, cell_height * rows))
+    for i in range(0, len(thumbs)):
+        sheet.paste(thumbs[i], ((i % columns) * cell_width, (i // columns) * cell_height))
+
+    with io.BytesIO() as fp:
+        sheet.save(fp, format="JPEG", quality=quality)
+        return fp.getvalue()
+
+
 def get_best_tensor_size(direction: str):
     # 在 7.5G 显存下（Tesla P4）可以使用的最大大小
     width, height = 704, 704
@@ -36,21 +63,26 @@ def select_best_tensor_size(width: int, height: int):
     min_blocks = 64
     min_pixels = min_blocks * 64 * 64
 
+    # 按面积等比缩放，边长缩放面积比的平方根
     total_pixels = width * height
     if total_pixels < min_pixels:
-        scale = min_pixels / total_pixels
+        scale = math.sqrt(min_pixels / total_pixels)
         width *= scale
         height *= scale
 
     total_pixels = width * height
     if total_pixels > max_pixels:
-        scale = max_pixels / total_pixels
+        scale = math.sqrt(max_pixels / total_pixels)
         width *= scale
         height *= scale
 
-    w_blocks = max(1, width // 64)
-    h_blocks = max(1, height // 64)
-    assert w_blocks * h_blocks <= max_blocks
+    w_blocks = max(1, int(width) // 64)
+    h_blocks = max(1, int(height) // 64)
+    while w_blocks * h_blocks > max_blocks:  # 极端长宽比下一边被抬到 1 块时可能超出
+        if w_blocks >= h_blocks:
+            w_blocks -= 1
+        else:
+            h_blocks -= 1
     return w_blocks * 64, h_blocks * 64
 
 
@@ -61,21 +93,41 @@ def mix_negative_prompts(input_negative: Optional[str], default_negative_prompts
 
 
 def make_comment_from_interaction(interaction: discord.Interaction):
-    return json.dumps({
+    ret = {
         "from": "discord",
         "name": interaction.user.name,
         "id": interaction.user.id,
         "ch_id": interaction.channel_id,
-    })
+    }
+    trace_id = current_trace_id()
+    if trace_id is not None:
+        ret["trace_id"] = trace_id
+    return json.dumps(ret)
 
 
 def make_comment_from_message(message: discord.Message):
-    return json.dumps({
+    ret = {
         "from": "discord",
         "name": message.author.name,
         "id": message.author.id,
         "ch_id": message.channel.id,
-    })
+    }
+    trace_id = current_trace_id()
+    if trace_id is not None:
+        ret["trace_id"] = trace_id
+    return json.dumps(ret)
+
+
+def make_speculative_comment(comment: Optional[str]):
+    # 预取任务并非用户发起，需要在注释中标明
+    ret = json.loads(comment) if comment else {}
+    ret["speculative"] = True
+    trace_id = current_trace_id()
+    if trace_id is not None:
+        ret["trace_id"] = trace_id
+    else:
+        ret.pop("trace_id", None)
+    return json.dumps(ret)
 
 
 # discord.py 似乎没有提供接受回调的类，需要自己覆盖 calllback 方法？